@@ -1,69 +1,397 @@
 
-import json
-from typing import TypedDict, List, Dict, Any, Literal
+import asyncio
+import functools
+import importlib.util
+import inspect
+import logging
+import os
+import re
+import sys
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from enum import Enum
+from logging.handlers import QueueHandler, QueueListener
+from operator import add, or_
+from queue import Queue
+from typing import Annotated, List, Dict, Any, Literal, Optional, Set, Tuple
+
+import httpx
+import orjson
+from langgraph.checkpoint.base import BaseCheckpointSaver
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
 from langgraph.graph import StateGraph, END
-
-class CommonMcpClient:
+from langgraph.types import Command
+
+logger = logging.getLogger("langie")
+
+_log_handler: Optional[QueueHandler] = None
+_log_listener: Optional[QueueListener] = None
+
+def configure_logging(level: int = logging.INFO) -> None:
+    """Emit `langie` log records to stdout from a background thread.
+
+    Stages only enqueue records; the stdout writes happen on the listener's
+    thread. Calling this again only changes the level. Call
+    `shutdown_logging()` to flush and detach. Use WARNING or above in
+    production to skip building the per-call records entirely.
+    """
+    global _log_handler, _log_listener
+    logger.setLevel(level)
+    if _log_listener is not None:
+        return
+    log_queue: Queue = Queue(-1)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    _log_handler = QueueHandler(log_queue)
+    _log_listener = QueueListener(log_queue, handler)
+    logger.addHandler(_log_handler)
+    logger.propagate = False
+    _log_listener.start()
+
+def shutdown_logging() -> None:
+    """Detach the queue handler, then flush and stop the writer thread."""
+    global _log_handler, _log_listener
+    if _log_listener is None:
+        return
+    logger.removeHandler(_log_handler)
+    logger.propagate = True
+    _log_listener.stop()
+    _log_handler = _log_listener = None
+
+
+# Keywords the simulated NLP abilities look for, matched case-insensitively.
+_KEYWORDS = ("error code 42", "error code", "pro-widget x", "urgent")
+# Longest first, so the alternation prefers "error code 42" over "error code".
+_KEYWORD_PATTERN = re.compile("|".join(re.escape(kw) for kw in sorted(_KEYWORDS, key=len, reverse=True)))
+# A match on a keyword also counts for every keyword it contains.
+_KEYWORDS_WITHIN = {kw: frozenset(other for other in _KEYWORDS if other in kw) for kw in _KEYWORDS}
+# Keywords reported as entities, with their canonical spelling.
+_ENTITY_KEYWORDS = (("pro-widget x", "Pro-Widget X"), ("error code 42", "error code 42"))
+
+def scan_keywords(text_lower: str) -> frozenset:
+    """Return the known keywords present in already-lowercased text, in a single pass."""
+    found = set()
+    for match in _KEYWORD_PATTERN.finditer(text_lower):
+        found.update(_KEYWORDS_WITHIN[match.group()])
+    return frozenset(found)
+
+
+def _render_response(name: str, query: str, title: str, summary: str) -> str:
+    """Draft the customer reply from constant segments joined in one allocation."""
+    return "".join((
+        "Hello ", name, ",\n\n"
+        "Thank you for contacting us about your query: '", query, "...'.\n\n"
+        "Based on our knowledge base, here is a relevant article that might help: '", title, "'.\n\n"
+        "Summary: ", summary, "\n\n"
+        "Regards,\nLangie Support Agent",
+    ))
+
+def _score_title(kb_title: str) -> int:
+    """Simulate scoring a solution based on relevance."""
+    # Let's pretend articles about "error code" are highly relevant.
+    return 95 if "error code" in kb_title.lower() else 75
+
+
+class McpError(RuntimeError):
+    """Raised when an MCP server answers a tool call with a JSON-RPC error."""
+
+
+class McpCallBatcher:
+    """Coalesces tool calls issued together into one round-trip.
+
+    Calls are queued until either `max_batch_size` calls are pending or the
+    flush fires, then handed to `executor` as a single list of
+    `(tool_name, arguments)` pairs. By default the flush runs on the next
+    event-loop tick, which already merges calls fired together (e.g. via
+    `asyncio.gather`) without delaying a lone call; a positive `max_wait_ms`
+    opts into waiting that long for stragglers. The executor returns
+    one result per call, in order; an exception in that list fails only the
+    matching call.
+    """
+    def __init__(self, executor, max_batch_size: int = 8, max_wait_ms: float = 0):
+        self._executor = executor
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait_ms / 1000
+        self._pending: List[Any] = []
+        self._flush_handle = None
+        # Strong references to in-flight dispatch tasks, so they are not
+        # garbage-collected before they finish.
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+    async def call(self, tool_name: str, arguments: Dict[str, Any]) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((tool_name, arguments, future))
+        if len(self._pending) >= self._max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            if self._max_wait > 0:
+                self._flush_handle = loop.call_later(self._max_wait, self._flush)
+            else:
+                self._flush_handle = loop.call_soon(self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._dispatch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, batch: List[Any]) -> None:
+        try:
+            results = await self._executor([(name, args) for name, args, _ in batch])
+        except Exception as exc:
+            results = [exc] * len(batch)
+        for (_, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+def cached_call(maxsize: int = 1024, ttl: Optional[float] = None):
+    """LRU cache for idempotent async client methods, with an optional TTL in seconds.
+
+    Arguments are bound to the method's signature, so positional and keyword
+    spellings of the same call share one cache key; their values must be
+    hashable. Results are stored serialized and decoded afresh on every hit,
+    so each caller gets its own copy and editing it cannot corrupt the cache.
+    """
+    def decorator(method):
+        signature = inspect.signature(method)
+        cache: "OrderedDict[Tuple[Any, ...], Tuple[bytes, float]]" = OrderedDict()
+
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = bound.args + tuple(sorted(bound.kwargs.items()))
+            now = time.monotonic()
+            entry = cache.get(key)
+            if entry is not None and (ttl is None or now - entry[1] < ttl):
+                cache.move_to_end(key)
+                return orjson.loads(entry[0])
+            result = await method(*bound.args, **bound.kwargs)
+            cache[key] = (orjson.dumps(result), now)
+            cache.move_to_end(key)
+            if len(cache) > maxsize:
+                cache.popitem(last=False)
+            return result
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
+
+
+# One HTTP session shared by every MCP client, so calls reuse pooled
+# connections instead of each paying for a TCP+TLS handshake. Concurrent
+# batches multiplex over HTTP/2 when the `h2` package (the `httpx[http2]`
+# extra) is installed; otherwise the pool falls back to HTTP/1.1 keep-alive.
+# The session is created on first use and belongs to the event loop that
+# first uses it: call `close_session()` once, before that loop shuts down.
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+_SESSION: Optional[httpx.AsyncClient] = None
+
+def get_session() -> httpx.AsyncClient:
+    """Return the shared MCP HTTP session, creating it if needed."""
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = httpx.AsyncClient(
+            http2=_HTTP2_AVAILABLE,
+            timeout=5.0,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        )
+    return _SESSION
+
+async def close_session() -> None:
+    """Close the shared MCP HTTP session, if one was opened."""
+    global _SESSION
+    if _SESSION is not None:
+        await _SESSION.aclose()
+        _SESSION = None
+
+
+class _McpClient:
+    """Base for the MCP clients: every tool call goes through a per-server batcher.
+
+    Each batch is sent as one JSON-RPC 2.0 batch payload, POSTed to `url`
+    over the shared session. Without a `url` the server is simulated
+    in-process by the `_tool_*` methods of the subclasses.
+    """
+    server_name = ""
+
+    def __init__(self, url: Optional[str] = None):
+        self._url = url
+        self._batcher = McpCallBatcher(executor=self._send_batch, max_batch_size=8)
+
+    async def _call(self, tool_name: str, **arguments: Any) -> Dict[str, Any]:
+        return await self._batcher.call(tool_name, arguments)
+
+    async def _send_batch(self, calls: List[Any]) -> List[Any]:
+        payload = orjson.dumps([
+            {"jsonrpc": "2.0", "id": i, "method": "tools/call", "params": {"name": name, "arguments": args}}
+            for i, (name, args) in enumerate(calls)
+        ])
+        if len(calls) > 1:
+            logger.debug("  📦 Sending %d calls to %s Server in one batch", len(calls), self.server_name)
+        if self._url is None:
+            body = self._serve_batch(payload)
+        else:
+            response = await get_session().post(
+                self._url, content=payload, headers={"Content-Type": "application/json"}
+            )
+            response.raise_for_status()
+            body = response.content
+        responses = {response["id"]: response for response in orjson.loads(body)}
+        results = []
+        for i in range(len(calls)):
+            response = responses[i]
+            if "error" in response:
+                results.append(McpError(response["error"]["message"]))
+            else:
+                results.append(response["result"])
+        return results
+
+    def _serve_batch(self, payload: bytes) -> bytes:
+        """Simulated server side: answer a JSON-RPC batch with a JSON-RPC batch."""
+        responses = []
+        for request in orjson.loads(payload):
+            params = request["params"]
+            tool = getattr(self, f"_tool_{params['name']}", None)
+            if tool is None:
+                error = {"code": -32601, "message": f"Unknown tool: {params['name']}"}
+                responses.append({"jsonrpc": "2.0", "id": request["id"], "error": error})
+                continue
+            try:
+                result = tool(**params["arguments"])
+            except Exception as exc:
+                error = {"code": -32603, "message": str(exc)}
+                responses.append({"jsonrpc": "2.0", "id": request["id"], "error": error})
+                continue
+            responses.append({"jsonrpc": "2.0", "id": request["id"], "result": result})
+        return orjson.dumps(responses)
+
+
+class CommonMcpClient(_McpClient):
     """Simulates a client for abilities with no external data dependencies."""
-    def parse_request_text(self, query: str) -> Dict[str, Any]:
-        print("  📞 Calling COMMON Server: parse_request_text")
+    server_name = "COMMON"
+
+    @cached_call(maxsize=1024)
+    async def parse_request_text(self, query: str, query_lower: str) -> Dict[str, Any]:
+        return await self._call("parse_request_text", query=query, query_lower=query_lower)
+
+    @cached_call(maxsize=1024)
+    async def normalize_fields(self, ticket_id: str) -> Dict[str, str]:
+        return await self._call("normalize_fields", ticket_id=ticket_id)
+
+    async def add_flags_calculations(self, priority: int, query_lower: str) -> Dict[str, Any]:
+        return await self._call("add_flags_calculations", priority=priority, query_lower=query_lower)
+
+    @cached_call(maxsize=1024)
+    async def solution_evaluation(self, kb_title: str) -> Dict[str, int]:
+        return await self._call("solution_evaluation", kb_title=kb_title)
+
+    async def solution_evaluation_batch(self, kb_titles: List[str]) -> Dict[str, List[int]]:
+        """Score many candidate articles (e.g. a rerank pass) in one round-trip."""
+        return await self._call("solution_evaluation_batch", kb_titles=kb_titles)
+
+    async def response_generation(self, customer_name: str, query: str, kb_article: Dict[str, Any]) -> Dict[str, str]:
+        return await self._call("response_generation", customer_name=customer_name, query=query, kb_article=kb_article)
+
+    # --- Simulated COMMON server tools ---
+    def _tool_parse_request_text(self, query: str, query_lower: str) -> Dict[str, Any]:
+        logger.debug("  📞 Calling COMMON Server: parse_request_text")
         # Simulate NLP: identify intent
-        if "error code" in query.lower():
+        if "error code" in scan_keywords(query_lower):
             return {"intent": "technical_support", "structured_query": query}
         return {"intent": "general_inquiry", "structured_query": query}
 
-    def normalize_fields(self, ticket_id: str) -> Dict[str, str]:
-        print("  📞 Calling COMMON Server: normalize_fields")
+    def _tool_normalize_fields(self, ticket_id: str) -> Dict[str, str]:
+        logger.debug("  📞 Calling COMMON Server: normalize_fields")
         # Simulate data cleaning
         return {"normalized_ticket_id": ticket_id.strip().upper()}
 
-    def add_flags_calculations(self, priority: int, query: str) -> Dict[str, Any]:
-        print("  📞 Calling COMMON Server: add_flags_calculations")
-        # Simulate risk calculation
-        is_urgent = "urgent" in query.lower() or priority > 3
+    def _tool_add_flags_calculations(self, priority: int, query_lower: str) -> Dict[str, Any]:
+        logger.debug("  📞 Calling COMMON Server: add_flags_calculations")
+        # Simulate risk calculation. The integer test goes first so that
+        # high-priority tickets skip the keyword scan.
+        is_urgent = priority > 3 or "urgent" in scan_keywords(query_lower)
         return {"is_urgent_flag": is_urgent, "calculated_priority": priority * 1.5 if is_urgent else priority}
 
-    def solution_evaluation(self, kb_article: Dict[str, Any]) -> Dict[str, int]:
-        print("  📞 Calling COMMON Server: solution_evaluation")
-        # Simulate scoring a solution based on relevance.
-        # Let's pretend articles about "error code" are highly relevant.
-        score = 95 if "error code" in kb_article.get("title", "").lower() else 75
-        return {"solution_score": score}
+    def _tool_solution_evaluation(self, kb_title: str) -> Dict[str, int]:
+        logger.debug("  📞 Calling COMMON Server: solution_evaluation")
+        return {"solution_score": _score_title(kb_title)}
+
+    def _tool_solution_evaluation_batch(self, kb_titles: List[str]) -> Dict[str, List[int]]:
+        logger.debug("  📞 Calling COMMON Server: solution_evaluation_batch (%d articles)", len(kb_titles))
+        return {"solution_scores": [_score_title(title) for title in kb_titles]}
 
-    def response_generation(self, customer_name: str, query: str, kb_article: Dict[str, Any]) -> Dict[str, str]:
-        print("  📞 Calling COMMON Server: response_generation")
+    def _tool_response_generation(self, customer_name: str, query: str, kb_article: Dict[str, Any]) -> Dict[str, str]:
+        logger.debug("  📞 Calling COMMON Server: response_generation")
         # Simulate drafting a response
-        response = (
-            f"Hello {customer_name},\n\n"
-            f"Thank you for contacting us about your query: '{query[:30]}...'.\n\n"
-            f"Based on our knowledge base, here is a relevant article that might help: '{kb_article['title']}'.\n\n"
-            f"Summary: {kb_article['summary']}\n\n"
-            f"Regards,\nLangie Support Agent"
-        )
+        response = _render_response(customer_name, query[:30], kb_article['title'], kb_article['summary'])
         return {"generated_response": response}
 
-class AtlasMcpClient:
+class AtlasMcpClient(_McpClient):
     """Simulates a client for abilities requiring external system interaction."""
-    def extract_entities(self, query: str) -> Dict[str, List[str]]:
-        print("  📞 Calling ATLAS Server: extract_entities")
+    server_name = "ATLAS"
+
+    async def extract_entities(self, query_lower: str) -> Dict[str, List[str]]:
+        return await self._call("extract_entities", query_lower=query_lower)
+
+    async def enrich_records(self, email: str) -> Dict[str, Any]:
+        return await self._call("enrich_records", email=email)
+
+    # KB articles can be edited, so cached lookups expire after five minutes.
+    @cached_call(maxsize=1024, ttl=300)
+    async def knowledge_base_search(self, entities: Tuple[str, ...]) -> Dict[str, Dict]:
+        return await self._call("knowledge_base_search", entities=entities)
+
+    async def escalation_decision(self, ticket_id: str) -> Dict[str, str]:
+        return await self._call("escalation_decision", ticket_id=ticket_id)
+
+    async def update_ticket(self, ticket_id: str, status: str, assignee: str) -> Dict[str, str]:
+        return await self._call("update_ticket", ticket_id=ticket_id, status=status, assignee=assignee)
+
+    async def close_ticket(self, ticket_id: str) -> Dict[str, str]:
+        return await self._call("close_ticket", ticket_id=ticket_id)
+
+    async def trigger_notifications(self, email: str, message: str) -> Dict[str, str]:
+        return await self._call("trigger_notifications", email=email, message=message)
+
+    async def finalize_ticket(self, ticket_id: str, email: str, message: str) -> Dict[str, str]:
+        """Notify the customer and close the ticket in a single round-trip."""
+        return await self._call("finalize_ticket", ticket_id=ticket_id, email=email, message=message)
+
+    # We will combine execute_api_calls with trigger_notifications for simplicity in this demo
+    async def execute_api_calls(self, email: str, message: str) -> Dict[str, str]:
+        return await self.trigger_notifications(email, message)
+
+    # --- Simulated ATLAS server tools ---
+    def _tool_extract_entities(self, query_lower: str) -> Dict[str, List[str]]:
+        logger.debug("  📞 Calling ATLAS Server: extract_entities")
         # Simulate entity extraction (e.g., product names, codes)
-        entities = []
-        if "Pro-Widget X" in query:
-            entities.append("Pro-Widget X")
-        if "error code 42" in query:
-            entities.append("error code 42")
+        keywords = scan_keywords(query_lower)
+        entities = [name for keyword, name in _ENTITY_KEYWORDS if keyword in keywords]
         return {"extracted_entities": entities}
 
-    def enrich_records(self, email: str) -> Dict[str, Any]:
-        print("  📞 Calling ATLAS Server: enrich_records")
+    def _tool_enrich_records(self, email: str) -> Dict[str, Any]:
+        logger.debug("  📞 Calling ATLAS Server: enrich_records")
         # Simulate fetching customer data from a CRM
         return {
             "customer_sla": "Gold",
             "historical_ticket_count": 5
         }
 
-    def knowledge_base_search(self, entities: List[str]) -> Dict[str, Dict]:
-        print("  📞 Calling ATLAS Server: knowledge_base_search")
+    def _tool_knowledge_base_search(self, entities: List[str]) -> Dict[str, Dict]:
+        logger.debug("  📞 Calling ATLAS Server: knowledge_base_search")
         # Simulate searching a KB
         if "error code 42" in entities:
             return {
@@ -75,196 +403,246 @@ class AtlasMcpClient:
             }
         return {"retrieved_kb_article": {}}
 
-    def escalation_decision(self, ticket_id: str) -> Dict[str, str]:
-        print("  📞 Calling ATLAS Server: escalation_decision")
+    def _tool_escalation_decision(self, ticket_id: str) -> Dict[str, str]:
+        logger.debug("  📞 Calling ATLAS Server: escalation_decision")
         # Simulate assigning to a human agent in a ticketing system
         return {"escalation_status": "Assigned to Tier 2 Support"}
 
-    def update_ticket(self, ticket_id: str, status: str, assignee: str) -> Dict[str, str]:
-        print(f"  📞 Calling ATLAS Server: update_ticket (Status: {status})")
+    def _tool_update_ticket(self, ticket_id: str, status: str, assignee: str) -> Dict[str, str]:
+        logger.debug("  📞 Calling ATLAS Server: update_ticket (Status: %s)", status)
         return {"ticket_update_status": "SUCCESS"}
 
-    def close_ticket(self, ticket_id: str) -> Dict[str, str]:
-        print(f"  📞 Calling ATLAS Server: close_ticket")
+    def _tool_close_ticket(self, ticket_id: str) -> Dict[str, str]:
+        logger.debug("  📞 Calling ATLAS Server: close_ticket")
         return {"ticket_close_status": "SUCCESS"}
 
-    def trigger_notifications(self, email: str, message: str) -> Dict[str, str]:
-        print(f"  📞 Calling ATLAS Server: trigger_notifications")
+    def _tool_trigger_notifications(self, email: str, message: str) -> Dict[str, str]:
+        logger.debug("  📞 Calling ATLAS Server: trigger_notifications")
         # Simulate sending an email
         return {"notification_status": "SENT"}
-    
-    # We will combine execute_api_calls with trigger_notifications for simplicity in this demo
-    def execute_api_calls(self, email: str, message: str) -> Dict[str, str]:
-        return self.trigger_notifications(email, message)
+
+    def _tool_finalize_ticket(self, ticket_id: str, email: str, message: str) -> Dict[str, str]:
+        logger.debug("  📞 Calling ATLAS Server: finalize_ticket")
+        # Simulate sending the email and then closing the ticket
+        return {"notification_status": "SENT", "ticket_close_status": "SUCCESS"}
+
+# Shared client instances: the stages reuse these (and their batchers) instead
+# of building fresh clients on every node invocation. Set the server URLs to
+# talk to real MCP servers; without them the servers are simulated in-process.
+COMMON = CommonMcpClient(url=os.environ.get("LANGIE_COMMON_MCP_URL"))
+ATLAS = AtlasMcpClient(url=os.environ.get("LANGIE_ATLAS_MCP_URL"))
 
 
 # ==============================================================================
 # 2. STATE MANAGEMENT
 # ==============================================================================
-# This defines the "memory" of our agent. It's passed between stages.
+# This defines the "memory" of our agent. It's passed between stages as a
+# slotted dataclass, so stages read fields as attributes.
+# Stages return only the fields they change; `log` entries are appended
+# through the `add` reducer rather than by mutating a shared list. The
+# dataclass is frozen so that a stage assigning to the state fails loudly.
+
+class Outcome(str, Enum):
+    """Result of the DECIDE stage.
+
+    The `str` mixin keeps the payload readable and lets routers compare with
+    `==`, so a plain "CREATE_RESPONSE" (from an external state update, or a
+    checkpoint restored without the enum) routes the same as the member.
+    """
+    CREATE_RESPONSE = "CREATE_RESPONSE"
+    ESCALATE = "ESCALATE"
+
+class Status(str, Enum):
+    """Final ticket status set by CREATE or UPDATE."""
+    RESOLVED = "RESOLVED"
+    ESCALATED = "ESCALATED"
+
+# Enum types a checkpointer may restore from msgpack. `final_status` is picked
+# up from the schema automatically, but `Outcome` sits inside the untyped
+# `decision` dict, so both are listed explicitly.
+MSGPACK_ALLOWLIST = (
+    (Outcome.__module__, Outcome.__qualname__),
+    (Status.__module__, Status.__qualname__),
+)
+# Serializer with the enums registered; pass it as a saver's `serde`, e.g.
+# `InMemorySaver(serde=CHECKPOINT_SERDE)`.
+CHECKPOINT_SERDE = JsonPlusSerializer(allowed_msgpack_modules=MSGPACK_ALLOWLIST)
 
-class AgentState(TypedDict):
+@dataclass(slots=True, frozen=True)
+class AgentOutput:
+    """The structured payload returned to the caller."""
     # --- Input Fields ---
     customer_name: str
     email: str
     query: str
     priority: int
     ticket_id: str
-    
-    # --- State Fields (added during workflow) ---
-    log: List[str]  # To track the agent's journey
-    structured_data: Dict[str, Any]
-    enriched_data: Dict[str, Any]
-    retrieved_kb_article: Dict[str, Any]
-    decision: Dict[str, Any]
-    final_response: str
-    final_status: Literal["RESOLVED", "ESCALATED"]
 
+    # --- State Fields (added during workflow) ---
+    log: Annotated[List[str], add] = field(default_factory=list)  # To track the agent's journey
+    # Each ability result is written separately and `or_` merges them.
+    structured_data: Annotated[Dict[str, Any], or_] = field(default_factory=dict)
+    enriched_data: Annotated[Dict[str, Any], or_] = field(default_factory=dict)
+    retrieved_kb_article: Dict[str, Any] = field(default_factory=dict)
+    decision: Dict[str, Any] = field(default_factory=dict)
+    final_response: str = ""
+    final_status: Optional[Status] = None
+
+@dataclass(slots=True, frozen=True)
+class AgentState(AgentOutput):
+    """The full workflow state: the output payload plus internal scratch fields."""
+    query_lower: str = ""  # Lowercased once at INTAKE for the text-matching abilities
 
 # ==============================================================================
 # 3. STAGE (NODE) IMPLEMENTATIONS
 # ==============================================================================
 # Each function represents a node in our graph.
 
-def stage_intake(state: AgentState) -> AgentState:
+def stage_intake(state: AgentState) -> Dict[str, Any]:
     """📥 Stage 1: INTAKE - Accept the initial payload."""
     log_message = "✅ STAGE: INTAKE - Payload accepted."
-    print(log_message)
-    state['log'].append(log_message)
+    logger.info(log_message)
     # No abilities to call, just accepting the initial state
-    return state
+    return {"log": [log_message], "query_lower": state.query.lower()}
 
-def stage_understand(state: AgentState) -> AgentState:
+async def stage_understand(state: AgentState) -> Command:
     """🧠 Stage 2: UNDERSTAND - Parse text and extract entities."""
     log_message = "✅ STAGE: UNDERSTAND"
-    print(log_message)
-    state['log'].append(log_message)
-
-    common_client = CommonMcpClient()
-    atlas_client = AtlasMcpClient()
+    logger.info(log_message)
 
-    parsed_result = common_client.parse_request_text(state['query'])
-    entities_result = atlas_client.extract_entities(state['query'])
+    # The two abilities are independent, so dispatch them concurrently.
+    parsed_result, entities_result = await asyncio.gather(
+        COMMON.parse_request_text(state.query, state.query_lower),
+        ATLAS.extract_entities(state.query_lower),
+    )
 
-    state['structured_data'] = {**parsed_result, **entities_result}
-    return state
+    # A Command carries one write per result; the `or_` reducer fuses them.
+    return Command(update=[
+        ("log", [log_message]),
+        ("structured_data", parsed_result),
+        ("structured_data", entities_result),
+    ])
 
-def stage_prepare(state: AgentState) -> AgentState:
+async def stage_prepare(state: AgentState) -> Command:
     """🛠️ Stage 3: PREPARE - Normalize, enrich, and add flags."""
     log_message = "✅ STAGE: PREPARE"
-    print(log_message)
-    state['log'].append(log_message)
+    logger.info(log_message)
 
-    common_client = CommonMcpClient()
-    atlas_client = AtlasMcpClient()
-    
-    normalized_result = common_client.normalize_fields(state['ticket_id'])
-    enriched_result = atlas_client.enrich_records(state['email'])
-    flags_result = common_client.add_flags_calculations(state['priority'], state['query'])
+    normalized_result, enriched_result, flags_result = await asyncio.gather(
+        COMMON.normalize_fields(state.ticket_id),
+        ATLAS.enrich_records(state.email),
+        COMMON.add_flags_calculations(state.priority, state.query_lower),
+    )
 
-    state['enriched_data'] = {**normalized_result, **enriched_result, **flags_result}
-    return state
+    return Command(update=[
+        ("log", [log_message]),
+        ("enriched_data", normalized_result),
+        ("enriched_data", enriched_result),
+        ("enriched_data", flags_result),
+    ])
     
-def stage_retrieve(state: AgentState) -> AgentState:
+async def stage_retrieve(state: AgentState) -> Dict[str, Any]:
     """📚 Stage 6: RETRIEVE - Search the knowledge base."""
     log_message = "✅ STAGE: RETRIEVE"
-    print(log_message)
-    state['log'].append(log_message)
+    logger.info(log_message)
 
-    atlas_client = AtlasMcpClient()
-    
-    kb_result = atlas_client.knowledge_base_search(state['structured_data']['extracted_entities'])
-    state['retrieved_kb_article'] = kb_result['retrieved_kb_article']
-    return state
+    # Sorted so that the same entities always hit the same cache entry.
+    entities = tuple(sorted(state.structured_data['extracted_entities']))
+    kb_result = await ATLAS.knowledge_base_search(entities)
+    return {"log": [log_message], "retrieved_kb_article": kb_result['retrieved_kb_article']}
 
-def stage_decide(state: AgentState) -> AgentState:
+# Entities whose KB article always scores as a sufficient solution. An exact
+# set rather than a Bloom filter: a false positive would resolve a ticket
+# that should have been escalated.
+KNOWN_RESOLVABLE_ENTITIES = frozenset({"error code 42"})
+
+async def stage_decide(state: AgentState) -> Dict[str, Any]:
     """⚖️ Stage 7: DECIDE - Evaluate solution and decide next step (non-deterministic)."""
     log_message = "✅ STAGE: DECIDE"
-    print(log_message)
-    state['log'].append(log_message)
+    logger.info(log_message)
+
+    entities = state.structured_data.get('extracted_entities', [])
+    if state.retrieved_kb_article and not KNOWN_RESOLVABLE_ENTITIES.isdisjoint(entities):
+        # Fast path: the article for this entity is known to be sufficient,
+        # so skip the solution_evaluation round-trip.
+        score = 95
+    else:
+        score_result = await COMMON.solution_evaluation(state.retrieved_kb_article.get("title", ""))
+        score = score_result['solution_score']
 
-    common_client = CommonMcpClient()
-    
-    score_result = common_client.solution_evaluation(state['retrieved_kb_article'])
-    score = score_result['solution_score']
-    
     if score >= 90:
         decision = "Sufficient solution found. Proceed to create response."
-        state['decision'] = {"score": score, "outcome": "CREATE_RESPONSE"}
+        decision_data = {"score": score, "outcome": Outcome.CREATE_RESPONSE}
     else:
         decision = "Solution score is low. Escalating to human agent."
-        atlas_client = AtlasMcpClient()
-        escalation_result = atlas_client.escalation_decision(state['ticket_id'])
-        state['decision'] = {"score": score, "outcome": "ESCALATE", **escalation_result}
+        escalation_result = await ATLAS.escalation_decision(state.ticket_id)
+        decision_data = {"score": score, "outcome": Outcome.ESCALATE, **escalation_result}
 
-    print(f"  🧠 Decision Logic: Score is {score}. {decision}")
-    state['log'].append(f"  Decision Logic: Score is {score}. {decision}")
-    return state
+    logger.info("  🧠 Decision Logic: Score is %s. %s", score, decision)
+    return {
+        "log": [log_message, f"  Decision Logic: Score is {score}. {decision}"],
+        "decision": decision_data,
+    }
 
-def stage_create(state: AgentState) -> AgentState:
+async def stage_create(state: AgentState) -> Dict[str, Any]:
     """✍️ Stage 9: CREATE - Generate a response for the customer."""
     log_message = "✅ STAGE: CREATE"
-    print(log_message)
-    state['log'].append(log_message)
-    
-    common_client = CommonMcpClient()
-    response_result = common_client.response_generation(
-        state['customer_name'],
-        state['query'],
-        state['retrieved_kb_article']
+    logger.info(log_message)
+
+    response_result = await COMMON.response_generation(
+        state.customer_name,
+        state.query,
+        state.retrieved_kb_article
     )
-    state['final_response'] = response_result['generated_response']
-    state['final_status'] = "RESOLVED"
-    return state
+    return {
+        "log": [log_message],
+        "final_response": response_result['generated_response'],
+        "final_status": Status.RESOLVED,
+    }
 
-def stage_update(state: AgentState) -> AgentState:
+async def stage_update(state: AgentState) -> Dict[str, Any]:
     """🔄 Stage 8: UPDATE - Update the ticket for escalation."""
     log_message = "✅ STAGE: UPDATE"
-    print(log_message)
-    state['log'].append(log_message)
-    
-    atlas_client = AtlasMcpClient()
-    atlas_client.update_ticket(
-        state['ticket_id'],
+    logger.info(log_message)
+
+    await ATLAS.update_ticket(
+        state.ticket_id,
         status="Escalated",
         assignee="Tier 2 Support"
     )
-    state['final_response'] = "This ticket has been escalated for human review."
-    state['final_status'] = "ESCALATED"
-    return state
+    return {
+        "log": [log_message],
+        "final_response": "This ticket has been escalated for human review.",
+        "final_status": Status.ESCALATED,
+    }
 
-def stage_do(state: AgentState) -> AgentState:
+async def stage_do(state: AgentState) -> Dict[str, Any]:
     """🏃 Stage 10: DO - Trigger notifications."""
     log_message = "✅ STAGE: DO"
-    print(log_message)
-    state['log'].append(log_message)
-    
-    atlas_client = AtlasMcpClient()
-    atlas_client.execute_api_calls(state['email'], state['final_response'])
-    return state
+    logger.info(log_message)
+
+    await ATLAS.execute_api_calls(state.email, state.final_response)
+    return {"log": [log_message]}
     
-def stage_close(state: AgentState) -> AgentState:
-    """✅ Stage 11: CLOSE - Close the ticket if resolved."""
-    log_message = "✅ STAGE: CLOSE"
-    print(log_message)
-    state['log'].append(log_message)
+async def stage_finalize(state: AgentState) -> Dict[str, Any]:
+    """✅ Stages 10 + 11: DO and CLOSE for resolved tickets - Notify, then close."""
+    log_message = "✅ STAGE: FINALIZE (DO + CLOSE)"
+    logger.info(log_message)
 
-    atlas_client = AtlasMcpClient()
-    atlas_client.close_ticket(state['ticket_id'])
-    return state
+    await ATLAS.finalize_ticket(state.ticket_id, state.email, state.final_response)
+    return {"log": [log_message]}
 
-def stage_complete(state: AgentState) -> AgentState:
+def stage_complete(state: AgentState) -> Dict[str, Any]:
     """🏁 STAGE: COMPLETE - Final output payload."""
     log_message = "✅ STAGE: COMPLETE - Workflow finished."
-    print(log_message)
-    state['log'].append(log_message)
+    logger.info(log_message)
     # This is the final node. No further actions.
-    return state
+    return {"log": [log_message]}
 
 # NOTE: STAGES 4 (ASK) and 5 (WAIT) would involve human-in-the-loop interaction.
 # They are defined here conceptually but not added to this specific graph flow for a single, non-interactive run.
-def stage_ask(state: AgentState): pass
-def stage_wait(state: AgentState): pass
+def stage_ask(state: AgentState) -> Dict[str, Any]: return {}
+def stage_wait(state: AgentState) -> Dict[str, Any]: return {}
 
 # ==============================================================================
 # 4. CONDITIONAL LOGIC (for non-deterministic routing)
@@ -272,87 +650,100 @@ def stage_wait(state: AgentState): pass
 
 def route_after_decision(state: AgentState) -> Literal["CREATE", "UPDATE"]:
     """Determines the next path after the DECIDE stage."""
-    print("  🚦 Routing based on decision...")
-    if state['decision']['outcome'] == "CREATE_RESPONSE":
-        print("  🚦 -> Path: CREATE")
+    logger.debug("  🚦 Routing based on decision...")
+    if state.decision['outcome'] == Outcome.CREATE_RESPONSE:
+        logger.debug("  🚦 -> Path: CREATE")
         return "CREATE"
     else:
-        print("  🚦 -> Path: UPDATE")
+        logger.debug("  🚦 -> Path: UPDATE")
         return "UPDATE"
 
-def route_after_do(state: AgentState) -> Literal["CLOSE", "__end__"]:
-    """Determines if the ticket should be closed or if the process ends (for escalations)."""
-    print("  🚦 Routing after DO...")
-    if state['final_status'] == "RESOLVED":
-        print("  🚦 -> Path: CLOSE")
-        return "CLOSE"
-    else: # Escalated tickets are not closed by the agent
-        print("  🚦 -> Path: END")
-        return END
-
 # ==============================================================================
 # 5. GRAPH ASSEMBLY
 # ==============================================================================
 
-# Initialize the state graph
-workflow = StateGraph(AgentState)
-
-# Add all the nodes (stages)
-workflow.add_node("INTAKE", stage_intake)
-workflow.add_node("UNDERSTAND", stage_understand)
-workflow.add_node("PREPARE", stage_prepare)
-workflow.add_node("RETRIEVE", stage_retrieve)
-workflow.add_node("DECIDE", stage_decide)
-workflow.add_node("CREATE", stage_create)
-workflow.add_node("UPDATE", stage_update)
-workflow.add_node("DO", stage_do)
-workflow.add_node("CLOSE", stage_close)
-workflow.add_node("COMPLETE", stage_complete)
-
-
-# Set the entry point
-workflow.set_entry_point("INTAKE")
-
-# Add deterministic edges
-workflow.add_edge("INTAKE", "UNDERSTAND")
-workflow.add_edge("UNDERSTAND", "PREPARE")
-workflow.add_edge("PREPARE", "RETRIEVE")
-workflow.add_edge("RETRIEVE", "DECIDE")
-
-# Add conditional edges for the non-deterministic DECIDE stage
-workflow.add_conditional_edges(
-    "DECIDE",
-    route_after_decision,
-    {
-        "CREATE": "CREATE",
-        "UPDATE": "UPDATE",
-    }
-)
-
-# Continue the flow from the two branches
-workflow.add_edge("CREATE", "DO")
-workflow.add_edge("UPDATE", "DO")
-
-# Add conditional edge after DO
-workflow.add_conditional_edges(
-    "DO",
-    route_after_do,
-    {
-        "CLOSE": "CLOSE",
-        END: END
-    }
-)
+def build_default_workflow() -> StateGraph:
+    """Assemble the standard support workflow (uncompiled)."""
+    # Initialize the state graph
+    # Internal fields such as query_lower stay out of the returned payload.
+    workflow = StateGraph(AgentState, output_schema=AgentOutput)
+
+    # Add all the nodes (stages)
+    workflow.add_node("INTAKE", stage_intake)
+    workflow.add_node("UNDERSTAND", stage_understand)
+    workflow.add_node("PREPARE", stage_prepare)
+    workflow.add_node("RETRIEVE", stage_retrieve)
+    workflow.add_node("DECIDE", stage_decide)
+    workflow.add_node("CREATE", stage_create)
+    workflow.add_node("UPDATE", stage_update)
+    # Resolved tickets are notified and closed by one FINALIZE call; escalated
+    # tickets only go through DO. Each branch therefore has fixed edges.
+    workflow.add_node("DO", stage_do)
+    workflow.add_node("FINALIZE", stage_finalize)
+    workflow.add_node("COMPLETE", stage_complete)
+
+    # Set the entry point
+    workflow.set_entry_point("INTAKE")
+
+    # Add deterministic edges
+    # UNDERSTAND and PREPARE only need the intake payload, so they fan out from
+    # INTAKE and run in parallel; RETRIEVE waits for both to finish.
+    workflow.add_edge("INTAKE", "UNDERSTAND")
+    workflow.add_edge("INTAKE", "PREPARE")
+    workflow.add_edge(["UNDERSTAND", "PREPARE"], "RETRIEVE")
+    workflow.add_edge("RETRIEVE", "DECIDE")
+
+    # Add conditional edges for the non-deterministic DECIDE stage
+    workflow.add_conditional_edges(
+        "DECIDE",
+        route_after_decision,
+        {
+            "CREATE": "CREATE",
+            "UPDATE": "UPDATE",
+        }
+    )
 
-workflow.add_edge("CLOSE", "COMPLETE")
-workflow.add_edge("COMPLETE", END)
+    # Continue the flow from the two branches
+    workflow.add_edge("CREATE", "FINALIZE")
+    workflow.add_edge("FINALIZE", "COMPLETE")
+    workflow.add_edge("UPDATE", "DO")
+    workflow.add_edge("DO", END) # Escalated tickets are not closed by the agent
+
+    workflow.add_edge("COMPLETE", END)
+    return workflow
+
+# Workflow variants by schema id. Add an entry here to serve another topology.
+WORKFLOW_BUILDERS = {
+    "default": build_default_workflow,
+}
+
+@functools.lru_cache(maxsize=16)
+def compiled_graph(schema_id: str, checkpointer: Optional[BaseCheckpointSaver] = None):
+    """Compile the workflow registered as `schema_id` once and reuse it.
+
+    A `checkpointer` gets `MSGPACK_ALLOWLIST` merged into its serializer's
+    allowlist (this only has an effect on a saver whose serializer already
+    uses an explicit allowlist, such as `CHECKPOINT_SERDE`, or when
+    LANGGRAPH_STRICT_MSGPACK is set).
+    """
+    if checkpointer is not None:
+        checkpointer = checkpointer.with_allowlist(MSGPACK_ALLOWLIST)
+    return WORKFLOW_BUILDERS[schema_id]().compile(checkpointer=checkpointer)
 
 # Compile the graph into a runnable app
-app = workflow.compile()
+app = compiled_graph("default")
 
 
 # ==============================================================================
 # 6. DEMO RUN
 # ==============================================================================
+async def run_demo(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Run the demo workflow, then release the shared MCP session as the demo's loop ends."""
+    try:
+        return await app.ainvoke(payload)
+    finally:
+        await close_session()
+
 if __name__ == "__main__":
     print("🚀 Initiating Langie Support Agent...")
     print("-" * 50)
@@ -364,19 +755,20 @@ if __name__ == "__main__":
         "query": "Hi, my Pro-Widget X is showing error code 42. I've tried restarting it but it didn't help. Can you assist?",
         "priority": 4,
         "ticket_id": "TKT-78901",
-        "log": [] # Initialize the log
     }
     
     print("📥 Sample Input Payload:")
-    print(json.dumps(sample_input, indent=2))
+    print(orjson.dumps(sample_input, option=orjson.OPT_INDENT_2).decode())
     print("-" * 50)
 
     # --- Run the Agent ---
-    final_state = app.invoke(sample_input)
+    configure_logging(logging.DEBUG)
+    final_state = asyncio.run(run_demo(sample_input))
+    shutdown_logging()
 
     print("-" * 50)
     print("✅ Final Structured Payload Output:")
     # Pretty print the final state
-    print(json.dumps(final_state, indent=2, default=str))
+    print(orjson.dumps(final_state, option=orjson.OPT_INDENT_2).decode())
     print("-" * 50)
     print("Langie Support Agent run complete. 🏁")